@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Request, request, jsonify, send_from_directory, send_file, make_response, abort
+from werkzeug.security import safe_join
 from flask_cors import CORS
 import subprocess
 import time
@@ -12,13 +13,72 @@ import joblib
 import warnings
 import google.generativeai as genai
 import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote
 import json
 import re
 import threading
+import atexit
+import queue
 import uuid
+import io
+import csv
+import hashlib
+import sqlite3
+from contextlib import closing, contextmanager
+import shutil
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl  # POSIX only: file locks for the shared results log
+except ImportError:
+    fcntl = None
+from functools import lru_cache
+import bisect
 warnings.filterwarnings('ignore')
 
+# Optional: Numba JIT for the complexity-only analysis kernel (OpenCV path otherwise)
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+class HashingWriter:
+    """File wrapper that BLAKE2b-hashes everything written through it"""
+    def __init__(self, f):
+        self._f = f
+        self.hash = hashlib.blake2b(digest_size=16)
+    
+    def write(self, data):
+        self.hash.update(data)
+        return self._f.write(data)
+    
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+class DiskSpooledRequest(Request):
+    """
+    Spool multipart file uploads straight to a named file in UPLOAD_FOLDER
+    (Werkzeug's default keeps them in memory / an anonymous temp file, which
+    then needs a full copy in file.save), hashing the bytes on the way
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        spool = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, suffix='.part', delete=False)
+        self.__dict__.setdefault('spool_paths', []).append(spool.name)
+        # Hash while spooling so the content hash costs no extra read
+        return HashingWriter(spool)
+    
+    def close(self):
+        super().close()
+        # Remove spool files that were never moved into place (e.g. aborted uploads)
+        for path in self.__dict__.get('spool_paths', []):
+            if os.path.exists(path):
+                os.remove(path)
+
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
+app.request_class = DiskSpooledRequest
 CORS(app)
 
 # Job queue for background processing
@@ -28,15 +88,43 @@ jobs = {}  # {job_id: {status, progress, result, error}}
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'outputs')
-RESULTS_FILE = os.path.join(BASE_DIR, 'outputs', 'results.xlsx')  # Save in outputs folder
+RESULTS_CSV = os.path.join(BASE_DIR, 'outputs', 'results.csv')  # Append-only results log
+RESULTS_FILE = os.path.join(BASE_DIR, 'outputs', 'results.xlsx')  # Legacy Excel log (migrated to CSV)
+RESULTS_HEADER = [
+    'Timestamp', 'Filename', 'Complexity',
+    'Normal_Energy_J', 'Rule_Energy_J', 'ML_Energy_J',
+    'Rule_Savings_%', 'ML_Savings_%',
+    'CO2_Normal_g', 'CO2_Rule_g', 'CO2_ML_g'
+]
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Content-hash cache of complexity analysis: {hash: (complexity, metadata, ML prediction)},
+# valid only for the analysis config fingerprint stored with it (ANALYSIS_CONFIG)
+ANALYSIS_CACHE_DB = os.path.join(OUTPUT_FOLDER, '.cache.db')
+with closing(sqlite3.connect(ANALYSIS_CACHE_DB)) as _db, _db:
+    _db.execute('CREATE TABLE IF NOT EXISTS analysis '
+                '(hash TEXT PRIMARY KEY, complexity REAL, width INTEGER, height INTEGER, fps INTEGER)')
+    # Columns added after the first cache version (ALTER fails once they exist)
+    for _column in ('duration REAL', 'ml_crf INTEGER', 'ml_preset TEXT', 'config TEXT'):
+        try:
+            _db.execute(f'ALTER TABLE analysis ADD COLUMN {_column}')
+        except sqlite3.OperationalError:
+            pass
+
+# Upload size limit (MB), enforced by Flask for both multipart and raw uploads
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', '4096')) * 1024 * 1024
+
 # Carbon intensity (grams CO2 per kWh) - Dynamic based on user location
 # Default: BESCOM Bangalore grid (0.71 tCO2/MWh = 710 g/kWh)
 # Will be updated via /api/carbon-intensity endpoint using Gemini AI
 DEFAULT_CARBON_INTENSITY = 710  # g CO2/kWh (Karnataka, India)
-CARBON_INTENSITY_CACHE = {}  # Session cache: {session_id: {intensity, region, timestamp}}
+# Lookup cache per 0.5° lat/lon cell (same grid region -> same intensity):
+# {(lat, lon): (response_dict, expires_ts)}, least recently used evicted first
+CARBON_INTENSITY_CACHE = OrderedDict()
+CARBON_INTENSITY_CACHE_LOCK = threading.Lock()
+CARBON_CACHE_TTL = 24 * 3600  # seconds
+CARBON_CACHE_SIZE = 1000
 
 # Gemini API Configuration
 # Set your API key as environment variable: export GEMINI_API_KEY="your-key-here"
@@ -47,11 +135,102 @@ if GEMINI_API_KEY:
 else:
     print("⚠️  GEMINI_API_KEY not set - using default Karnataka carbon intensity")
 
+# One Gemini model object for all lookups (its client and connection are reused)
+GEMINI_MODEL = genai.GenerativeModel('gemini-2.0-flash') if GEMINI_API_KEY else None
+
+# Shared HTTP session for reverse geocoding: keeps the TLS connection alive between lookups
+HTTP = requests.Session()
+HTTP.headers.update({'User-Agent': 'GreenAI-VideoTranscoder/1.0'})
+HTTP.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# OpenCV T-API: cvtColor/Canny/absdiff run on the GPU via OpenCL when a device is present
+USE_OPENCL = cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+if USE_OPENCL:
+    print("✅ OpenCL acceleration enabled for video analysis")
+
 # EC2 Power Calibration Results (measured on 2025-11-20)
 # t2.micro instance-specific power consumption
 P_IDLE_W = 0.016  # Watts - idle power consumption
 P_MAX_W = 28.000  # Watts - max load power consumption
 
+# Logical CPUs, read once at startup instead of re-querying the OS per transcode
+CPU_COUNT = psutil.cpu_count() or 1
+
+# Transcodes that may run side by side: only overlap them when the host has at
+# least 4 cores per job
+# (TRANSCODE_WORKERS=1 forces serial runs, e.g. for clean per-mode energy numbers;
+# 0 or negative values are clamped to 1)
+TRANSCODE_WORKERS = max(1, int(os.getenv('TRANSCODE_WORKERS', min(3, CPU_COUNT // 4))))
+
+# libx264 threads per transcode: the cores shared out between the parallel jobs
+# (a fixed -threads 4 oversubscribes small instances such as a 1 vCPU t2.micro)
+X264_THREADS = max(1, CPU_COUNT // TRANSCODE_WORKERS)
+
+# Uploads processed at once; later ones wait in the executor queue (still reported
+# as 'processing' at 0%) instead of all fighting for the CPU; at least one worker
+JOB_WORKERS = max(1, int(os.getenv('JOB_WORKERS', 2)))
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+# Single-pass mode (opt-in): encode every output (normal, rule-based, ML) from one
+# FFmpeg decode. Saves the extra decodes and process starts, but the per-output
+# energy becomes an equal split
+SINGLE_PASS = os.getenv('SINGLE_PASS', '0') == '1'
+
+# Start the baseline (normal) encode while the complexity analysis runs - it doesn't
+# depend on it. Same contention as parallel transcodes, so it follows TRANSCODE_WORKERS
+# unless OVERLAP_BASELINE=1/0 is set; single-pass needs all outputs together
+OVERLAP_BASELINE = (os.getenv('OVERLAP_BASELINE', '1' if TRANSCODE_WORKERS > 1 else '0') == '1'
+                    and CPU_COUNT > 1 and not SINGLE_PASS)
+
+# Decode the next sampled frame in a helper thread while the current one is analyzed
+# (needs a spare core; on one vCPU the two would only time-slice)
+PREFETCH_FRAMES = CPU_COUNT > 1
+
+# Frame sampling: a seek decodes from the previous keyframe, so it only beats
+# sequential grab() when samples are further apart than a GOP (x264 default keyint)
+SEEK_MIN_INTERVAL = 250
+
+# Behind nginx: hand /outputs downloads to the proxy (X-Accel-Redirect to an
+# internal location aliased to OUTPUT_FOLDER) so it serves them with sendfile
+X_ACCEL_OUTPUTS = os.getenv('X_ACCEL_OUTPUTS', '0') == '1'
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/internal_outputs/')
+
+# Opt-in (HW_ENCODE=1): hardware H.264 encoder for the adaptive rule/ML outputs,
+# probed once at startup. The baseline 'normal' output always stays on libx264.
+# Energy is modelled from FFmpeg's CPU time only, so GPU/ASIC encode power is not
+# counted - hardware runs are faster but NOT energy-comparable with the baseline
+VAAPI_DEVICE = '/dev/dri/renderD128'
+NVIDIA_DEVICE = '/dev/nvidia0'
+HW_ENCODE = os.getenv('HW_ENCODE', '0') == '1'
+
+# Preference order: (encoder, device node that must exist, label)
+HW_ENCODERS = [
+    ('h264_nvenc', NVIDIA_DEVICE, 'NVENC'),
+    ('h264_vaapi', VAAPI_DEVICE, 'VA-API'),
+    ('h264_qsv', VAAPI_DEVICE, 'Quick Sync'),
+]
+
+def detect_hw_encoder():
+    """
+    First hardware H.264 encoder that this FFmpeg build has AND whose device exists
+    (builds often ship nvenc/qsv without the hardware)
+    Returns: encoder name, or None to use libx264
+    """
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                capture_output=True, text=True, timeout=10)
+    except Exception as e:
+        print(f"⚠️ Could not list FFmpeg encoders: {e}")
+        return None
+    for encoder, device, label in HW_ENCODERS:
+        if f' {encoder} ' in result.stdout and os.path.exists(device):
+            print(f"✅ {label} encoder found ({device}): adaptive modes use {encoder}")
+            return encoder
+    return None
+
+HW_ENCODER = detect_hw_encoder() if HW_ENCODE else None
+
 # Load ML models at startup
 try:
     CRF_MODEL = joblib.load(os.path.join(BASE_DIR, 'crf_model.pkl'))
@@ -65,6 +244,102 @@ except Exception as e:
     PRESET_MODEL = None
     ML_AVAILABLE = False
 
+# Opt-in: convert the forests to ONNX at startup and predict through ONNX Runtime.
+# ORT compares features in float32, so a value sitting right on a split threshold
+# can fall to the other side than in sklearn; ONNX_MODELS=1 enables it
+ONNX_MODELS = os.getenv('ONNX_MODELS', '0') == '1'
+
+# Model input columns, in training order
+ML_FEATURES = ('edge_density', 'motion_score', 'brightness', 'color_variance',
+               'resolution', 'fps', 'duration')
+
+def load_onnx_sessions():
+    """ONNX Runtime sessions for (CRF_MODEL, PRESET_MODEL), or None to stay on sklearn"""
+    if not (ML_AVAILABLE and ONNX_MODELS):
+        return None
+    # Optional: ONNX Runtime (forest evaluated in C++, not per-tree Python), only
+    # imported when enabled so the default startup doesn't pay for onnx/protobuf
+    try:
+        import onnxruntime as ort
+        from skl2onnx import to_onnx
+    except Exception as e:  # also a protobuf version clash (onnx vs google-generativeai pins)
+        print(f"⚠️  ONNX Runtime not available, using sklearn models: {e}")
+        return None
+    try:
+        sessions = []
+        for model in (CRF_MODEL, PRESET_MODEL):
+            onx = to_onnx(model, np.zeros((1, len(ML_FEATURES)), dtype=np.float32),
+                          options={type(model): {'zipmap': False}}, target_opset=15)
+            sessions.append(ort.InferenceSession(onx.SerializeToString(),
+                                                 providers=['CPUExecutionProvider']))
+        print("✅ ML models converted to ONNX Runtime")
+        return sessions
+    except Exception as e:
+        print(f"⚠️  ONNX conversion failed, using sklearn models: {e}")
+        return None
+
+ONNX_SESSIONS = load_onnx_sessions()
+
+def predict_models(feature_vector):
+    """Raw (crf, preset) model outputs for one float32 feature row"""
+    if ONNX_SESSIONS:
+        return tuple(sess.run(None, {sess.get_inputs()[0].name: feature_vector})[0][0]
+                     for sess in ONNX_SESSIONS)
+    return CRF_MODEL.predict(feature_vector)[0], PRESET_MODEL.predict(feature_vector)[0]
+
+# Without the ML models the extracted features only feed the complexity score, so:
+# - edge density uses the cheaper thresholded Sobel magnitude on a 1/4-scale frame
+#   (the models were trained on full-resolution Canny, no NMS/hysteresis needed here)
+# - frames are decoded as luma only (no YUV->BGR->GRAY round trip)
+# USE_CANNY=1 keeps Canny anyway, for complexity scores comparable with ML-enabled runs
+COMPLEXITY_ONLY = not ML_AVAILABLE
+EDGE_PROXY = COMPLEXITY_ONLY and os.getenv('USE_CANNY', '0') != '1'
+CANNY_EDGE_NORM = 0.15  # Canny density that maps to edge score 10
+SOBEL_EDGE_NORM = 0.84  # Sobel proxy is ~5.6x denser than Canny on typical frames
+
+# Numba kernel for the complexity-only edge/motion stats (needs host, not OpenCL, buffers)
+USE_NUMBA = NUMBA_AVAILABLE and EDGE_PROXY and not USE_OPENCL
+
+# Opt-in: run the per-frame analysis on frames shrunk to fit WORK_RES (~8x fewer
+# pixels at 1080p; WORK_RES=320x180 for ~36x). Motion/edge statistics shift (fine
+# textures average out), and the ML models were trained on full-resolution
+# features, so it is off by default. The resolution feature stays the source size
+WORK_RES = tuple(int(v) for v in os.getenv('WORK_RES', '480x270').split('x'))
+DOWNSAMPLE_ANALYSIS = os.getenv('DOWNSAMPLE_ANALYSIS', '0') == '1'
+
+# Bump when the feature extraction or complexity scoring changes
+ANALYSIS_VERSION = 2
+
+def analysis_config():
+    """
+    Fingerprint of everything a cached analysis depends on: the analysis settings and
+    the model files (mtime/size), so retrained models or a complexity-only run never
+    leak into a later configuration
+    """
+    models = []
+    for name in ('crf_model.pkl', 'preset_model.pkl'):
+        try:
+            st = os.stat(os.path.join(BASE_DIR, name))
+            models.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            models.append(None)
+    config = (ANALYSIS_VERSION, ML_AVAILABLE, EDGE_PROXY, DOWNSAMPLE_ANALYSIS, WORK_RES,
+              ONNX_SESSIONS is not None, models)
+    return hashlib.blake2b(repr(config).encode(), digest_size=8).hexdigest()
+
+ANALYSIS_CONFIG = analysis_config()
+
+# Limited-range (TV, 16-235) luma is stretched to match cvtColor(BGR2GRAY) output;
+# full-range (yuvj*/pc) luma is used as-is
+LUMA_TO_FULL_RANGE = np.clip((np.arange(256) - 16) * 255 / 219, 0, 255).round().astype(np.uint8)
+
+# Rule-based tiers: complexity < 3.5 (talking heads, static scenes), < 7.0 (normal
+# videos), and above (action, sports)
+COMPLEXITY_THRESHOLDS = (3.5, 7.0)
+RULE_PRESETS = ('faster', 'fast', 'medium')  # quick encode -> preserve quality
+RULE_CRFS = ('28', '26', '24')  # aggressive compression -> preserve quality
+
+@lru_cache(maxsize=256)
 def predict_optimal_preset(complexity, width, height, fps, size_mb):
     """
     Determine optimal FFmpeg preset based on video complexity
@@ -74,42 +349,32 @@ def predict_optimal_preset(complexity, width, height, fps, size_mb):
              Balances encoding speed with file size for long-term efficiency
     """
     # Lifecycle-optimized preset selection
-    if complexity < 3.5:
-        # Low complexity (talking heads, static scenes)
-        return 'faster'  # Quick encode, good compression
-    elif complexity < 7.0:
-        # Medium complexity (normal videos)
-        return 'fast'  # Balanced speed and file size
-    else:
-        # High complexity (action, sports)
-        return 'medium'  # Preserve quality, minimize file size
+    return RULE_PRESETS[bisect.bisect_right(COMPLEXITY_THRESHOLDS, complexity)]
+
+def rule_crf(complexity):
+    """Adaptive CRF: simpler videos can use higher CRF (more compression, smaller file)"""
+    return RULE_CRFS[bisect.bisect_right(COMPLEXITY_THRESHOLDS, complexity)]
 
-def predict_ml_settings(video_path):
+def predict_ml_settings(video_path, features=None):
     """
     Use ML models to predict optimal CRF and preset
+    features: optional features already extracted from video_path
     Returns: (crf, preset) or None if ML not available
     """
     if not ML_AVAILABLE:
         return None
     
     try:
-        # Extract features
-        features = extract_ml_features(video_path)
-        
-        # Prepare feature vector in correct order
-        feature_vector = [[
-            features['edge_density'],
-            features['motion_score'],
-            features['brightness'],
-            features['color_variance'],
-            features['resolution'],
-            features['fps'],
-            features['duration']
-        ]]
+        # Extract features (cached from the complexity analysis of the same upload)
+        if features is None:
+            features = extract_ml_features(video_path)
+        
+        # Prepare feature vector in training order (float32: what the trees compare in)
+        feature_vector = np.asarray([[features[k] for k in ML_FEATURES]], dtype=np.float32)
         
         # Predict CRF and preset
-        predicted_crf = int(CRF_MODEL.predict(feature_vector)[0])
-        predicted_preset = PRESET_MODEL.predict(feature_vector)[0]
+        crf, predicted_preset = predict_models(feature_vector)
+        predicted_crf = int(crf)
         
         print(f"🤖 ML Prediction: CRF {predicted_crf}, Preset {predicted_preset}")
         
@@ -119,13 +384,247 @@ def predict_ml_settings(video_path):
         print(f"ML prediction error: {e}")
         return None
 
-def extract_ml_features(video_path):
+def iter_sampled_frames(cap, frame_count, sample_interval):
+    """
+    Yield every sample_interval-th frame without converting the skipped ones
+    Seeks straight to each sample point when samples are at least a GOP apart;
+    otherwise (or if the container can't seek accurately, e.g. VFR) walks the
+    stream with grab()/retrieve()
+    """
+    if frame_count <= 0 or sample_interval < SEEK_MIN_INTERVAL:
+        # Seeking would re-decode from the previous keyframe for every sample
+        yield from grab_sampled_frames(cap, 0, sample_interval)
+        return
+
+    for target_idx in range(0, frame_count, sample_interval):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, target_idx)
+        if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != target_idx:
+            # Inaccurate seek: rewind once and walk the remaining samples sequentially
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            yield from grab_sampled_frames(cap, target_idx, sample_interval)
+            return
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame
+
+def grab_sampled_frames(cap, start_idx, sample_interval):
+    """
+    Sequential fallback for iter_sampled_frames
+    grab() every frame (no YUV->BGR conversion) and retrieve() only the sampled ones
+    """
+    frame_idx = 0
+    while cap.grab():
+        if frame_idx >= start_idx and frame_idx % sample_interval == 0:
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            yield frame
+        frame_idx += 1
+
+def prefetch(iterable, depth=2):
+    """
+    Iterate `iterable` in a helper thread, up to `depth` items ahead of the consumer
+    Lets frame decoding (which releases the GIL) overlap the per-frame stats
+    Closing the generator stops and joins the helper thread
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+    
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            ok, item = items.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def pooled_std(frame):
+    """
+    np.std(frame) over all pixels and channels, from OpenCV's per-channel meanStdDev
+    (one SIMD pass, no float64 temporaries): pooled variance = E[var_c + mean_c^2] - mean^2
+    """
+    mean, std = cv2.meanStdDev(frame)
+    mean, std = mean.ravel(), std.ravel()
+    return float(np.sqrt(max(0.0, (std ** 2 + mean ** 2).mean() - mean.mean() ** 2)))
+
+def proxy_frame(gray, size):
+    """gray shrunk to the (w, h) edge-proxy size (as is when it already has that size)"""
+    if not isinstance(gray, cv2.UMat) and gray.shape[::-1] == size:
+        return gray
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+def sobel_edge_count(gray, size):
+    """
+    Edge-pixel count of gray at the (w, h) proxy size (1/4 scale) using thresholded
+    Sobel magnitude
+    Cheap stand-in for Canny when the value is only used for the complexity score
+    """
+    small = proxy_frame(gray, size)
+    gx = cv2.Sobel(small, cv2.CV_16S, 1, 0, ksize=3)
+    gy = cv2.Sobel(small, cv2.CV_16S, 0, 1, ksize=3)
+    mag = cv2.add(cv2.convertScaleAbs(gx), cv2.convertScaleAbs(gy))
+    # threshold + countNonZero are SIMD kernels; faster here than np.count_nonzero(mag > 100)
+    _, mask = cv2.threshold(mag, 100, 255, cv2.THRESH_BINARY)
+    return cv2.countNonZero(mask)
+
+if NUMBA_AVAILABLE:
+    # Serial on purpose: it runs on job threads, and Numba's parallel threading layers
+    # either abort on concurrent callers (workqueue) or block interpreter exit (TBB)
+    @njit(fastmath=True, cache=True)
+    def frame_stats_kernel(small, gray, prev_gray):
+        """
+        Complexity-only per-frame stats: edges in one pass over `small`, motion and
+        brightness fused into one pass over `gray`
+        Returns: (edge pixels of `small` as in sobel_edge_count, sum of |gray - prev_gray|,
+                  sum of gray)
+        """
+        h, w = small.shape
+        edge_count = 0
+        for i in range(h):
+            # BORDER_REFLECT_101, like cv2.Sobel
+            up = i - 1 if i > 0 else 1
+            down = i + 1 if i < h - 1 else h - 2
+            for j in range(w):
+                left = j - 1 if j > 0 else 1
+                right = j + 1 if j < w - 1 else w - 2
+                gx = (np.int32(small[up, right]) + 2 * np.int32(small[i, right]) + np.int32(small[down, right])
+                      - np.int32(small[up, left]) - 2 * np.int32(small[i, left]) - np.int32(small[down, left]))
+                gy = (np.int32(small[down, left]) + 2 * np.int32(small[down, j]) + np.int32(small[down, right])
+                      - np.int32(small[up, left]) - 2 * np.int32(small[up, j]) - np.int32(small[up, right]))
+                # convertScaleAbs + cv2.add saturate at 255 before the > 100 threshold
+                if min(abs(gx), 255) + min(abs(gy), 255) > 100:
+                    edge_count += 1
+        
+        motion_sum = 0
+        brightness_sum = 0
+        for i in range(gray.shape[0]):
+            for j in range(gray.shape[1]):
+                pixel = np.int32(gray[i, j])
+                motion_sum += abs(pixel - np.int32(prev_gray[i, j]))
+                brightness_sum += pixel
+        
+        return edge_count, motion_sum, brightness_sum
+
+# Codec pixel formats whose raw buffer starts with a full 8-bit Y plane (4:2:0).
+# Anything else (10-bit, 4:2:2, 4:4:4, ...) goes through BGR->GRAY
+RAW_LUMA_FOURCCS = (b'I420', b'IYUV', b'YV12', b'NV12', b'NV21')
+
+def luma_range(video_path):
+    """'pc' (full) or 'tv' (limited) range of the video stream, None if unknown"""
+    try:
+        return _luma_range(feature_cache_key(video_path))
+    except OSError:
+        return None
+
+@lru_cache(maxsize=256)
+def _luma_range(key):
+    # OpenCV reports yuv420p and yuvj420p both as I420, so read the range from the
+    # stream line of FFmpeg's header dump, e.g. "Video: h264 (High), yuvj420p(pc, ...)"
+    try:
+        probe = subprocess.run(['ffmpeg', '-hide_banner', '-i', key[0]], capture_output=True,
+                               text=True, errors='replace', timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = re.search(r'Video: [^,]*, (\w+)(?:\(([^)]*)\))?', probe.stderr)
+    if not match:
+        return None
+    pix_fmt, details = match.group(1), (match.group(2) or '').split(', ')
+    return 'pc' if pix_fmt.startswith('yuvj') or 'pc' in details else 'tv'
+
+def open_video_capture(video_path):
+    """Open a video for analysis (FFmpeg backend; luma-only frames when colour is unused)"""
+    cap = cv2.VideoCapture(video_path, cv2.CAP_FFMPEG)
+    if COMPLEXITY_ONLY:
+        fourcc = (int(cap.get(cv2.CAP_PROP_CODEC_PIXEL_FORMAT)) & 0xFFFFFFFF).to_bytes(4, 'little')
+        if fourcc in RAW_LUMA_FOURCCS and luma_range(video_path):
+            # Only luma is needed: take the decoder's Y plane as-is (no RGB conversion)
+            cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+    return cap
+
+# Raw (CONVERT_RGB=0) frames make OpenCV log "Unknown/unsupported picture format:
+# yuv420p" once per retrieved frame. The log level is process-wide, so it is lowered
+# while any analysis is reading luma frames and restored when the last one finishes
+_QUIET_CAPTURES = 0
+_QUIET_CAPTURES_LOCK = threading.Lock()
+_QUIET_CAPTURES_LEVEL = None  # level to restore (e.g. set via OPENCV_LOG_LEVEL)
+
+@contextmanager
+def quiet_luma_capture():
+    """Mute OpenCV warnings while luma-only frames are being read"""
+    global _QUIET_CAPTURES, _QUIET_CAPTURES_LEVEL
+    if not COMPLEXITY_ONLY:
+        yield
+        return
+    with _QUIET_CAPTURES_LOCK:
+        if _QUIET_CAPTURES == 0:
+            _QUIET_CAPTURES_LEVEL = cv2.utils.logging.getLogLevel()
+            cv2.utils.logging.setLogLevel(min(_QUIET_CAPTURES_LEVEL, cv2.utils.logging.LOG_LEVEL_ERROR))
+        _QUIET_CAPTURES += 1
+    try:
+        yield
+    finally:
+        with _QUIET_CAPTURES_LOCK:
+            _QUIET_CAPTURES -= 1
+            if _QUIET_CAPTURES == 0:
+                cv2.utils.logging.setLogLevel(_QUIET_CAPTURES_LEVEL)
+
+# Features per (path, mtime, size): the complexity analysis and the ML prediction
+# for the same upload share one decode pass. LRU-bounded to FEATURE_CACHE_SIZE files
+_FEATURE_CACHE = OrderedDict()
+_FEATURE_CACHE_LOCK = threading.Lock()
+FEATURE_CACHE_SIZE = 128
+
+def feature_cache_key(video_path):
+    """Cache key that changes if the file at video_path is replaced"""
+    st = os.stat(video_path)
+    return (video_path, st.st_mtime_ns, st.st_size)
+
+def extract_ml_features(video_path, cap=None):
     """
     Extract ALL 7 features needed for ML model prediction
+    cap: an already opened capture (see open_video_capture) to reuse; it is released here
+    Results are cached, so a second call for the same file doesn't decode it again
     Returns dict with: edge_density, motion_score, brightness, color_variance, resolution, fps, duration
     """
     try:
-        cap = cv2.VideoCapture(video_path)
+        key = feature_cache_key(video_path)
+        with _FEATURE_CACHE_LOCK:
+            cached = _FEATURE_CACHE.get(key)
+            if cached is not None:
+                _FEATURE_CACHE.move_to_end(key)
+        if cached is not None:
+            if cap is not None:
+                cap.release()
+            return dict(cached)
+        
+        if cap is None:
+            cap = open_video_capture(video_path)
         
         # Get video properties
         fps = cap.get(cv2.CAP_PROP_FPS)
@@ -137,55 +636,100 @@ def extract_ml_features(video_path):
         # Sample 1 frame per second (fast sampling)
         sample_interval = int(fps) if fps > 0 else 1
         
-        edge_scores = []
-        motion_scores = []
-        brightness_scores = []
-        color_variances = []
-        prev_gray = None
-        
-        frame_idx = 0
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            # Only process sampled frames (1 per second)
-            if frame_idx % sample_interval == 0:
-                # Convert to grayscale
-                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-                
-                # Feature 1: Edge density
-                edges = cv2.Canny(gray, 100, 200)
-                edge_scores.append(np.mean(edges) / 255.0)
-                
-                # Feature 2: Motion (frame difference)
-                if prev_gray is not None:
-                    diff = cv2.absdiff(gray, prev_gray)
-                    motion_scores.append(np.mean(diff) / 255.0)
-                prev_gray = gray.copy()
-                
-                # Feature 3: Brightness
-                brightness_scores.append(np.mean(gray) / 255.0)
-                
-                # Feature 4: Color variance
-                color_variances.append(np.std(frame) / 255.0)
-            
-            frame_idx += 1
+        # Working size for the per-frame stats (None = full resolution)
+        work_size = None
+        if DOWNSAMPLE_ANALYSIS and width > 0 and height > 0:
+            scale = min(WORK_RES[0] / width, WORK_RES[1] / height)
+            if scale < 1:
+                work_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # Edge-proxy frame: 1/4 of the source, but never larger than the (shrunk) work frame
+        proxy_size = (max(1, width // 4), max(1, height // 4))
+        if work_size:
+            proxy_size = (min(proxy_size[0], work_size[0]), min(proxy_size[1], work_size[1]))
+        # The kernel's reflect-101 border indexing needs 2+ pixels each way (Numba doesn't
+        # bounds-check); tiny sources use the OpenCV path
+        use_kernel = USE_NUMBA and min(proxy_size) >= 2
         
+        # Running per-feature sums over the n sampled frames (motion has n - 1 pairs)
+        edge_sum = motion_sum = brightness_sum = color_sum = 0.0
+        prev_gray = None
+        n = 0
+
+        # Only decode the sampled frames (1 per second)
+        frames = iter_sampled_frames(cap, frame_count, sample_interval)
+        if PREFETCH_FRAMES:
+            frames = prefetch(frames)
+        # closing() stops the decode thread before the capture is released (and before unmuting)
+        with quiet_luma_capture(), closing(frames):
+            for frame in frames:
+                if frame.ndim == 2:
+                    # Raw YUV frame: the first `height` rows are the Y plane
+                    gray = frame[:height]
+                    if luma_range(video_path) == 'tv':
+                        gray = cv2.LUT(gray, LUMA_TO_FULL_RANGE)
+                    if USE_OPENCL:
+                        gray = cv2.UMat(gray)
+                else:
+                    # Convert to grayscale (on the GPU when OpenCL is available)
+                    gray = cv2.cvtColor(cv2.UMat(frame) if USE_OPENCL else frame, cv2.COLOR_BGR2GRAY)
+                if work_size:
+                    gray = cv2.resize(gray, work_size, interpolation=cv2.INTER_AREA)
+                    if frame.ndim == 3:
+                        frame = cv2.resize(frame, work_size, interpolation=cv2.INTER_AREA)
+
+                if use_kernel:
+                    # Features 1-3 from one JIT-compiled kernel (same values as the OpenCV path below)
+                    small = proxy_frame(gray, proxy_size)
+                    edge_count, diff_sum, gray_sum = frame_stats_kernel(
+                        small, gray, gray if prev_gray is None else prev_gray)
+                    edge_sum += edge_count
+                    if prev_gray is not None:
+                        motion_sum += diff_sum / gray.size
+                    brightness_sum += gray_sum / gray.size
+                else:
+                    # Feature 1: Edge density (edge-pixel count, normalized by pixel count below)
+                    if EDGE_PROXY:
+                        edge_sum += sobel_edge_count(gray, proxy_size)
+                    else:
+                        edges = cv2.Canny(gray, 100, 200)
+                        edge_sum += cv2.countNonZero(edges)
+
+                    # Feature 2: Motion (frame difference)
+                    if prev_gray is not None:
+                        diff = cv2.absdiff(gray, prev_gray)
+                        motion_sum += cv2.mean(diff)[0]
+
+                    # Feature 3: Brightness
+                    brightness_sum += cv2.mean(gray)[0]
+                prev_gray = gray  # gray is a new buffer every sample, no copy needed
+
+                # Feature 4: Color variance (needs BGR; unused for luma-only complexity runs)
+                if frame.ndim == 3:
+                    color_sum += pooled_std(frame)
+                n += 1
+
         cap.release()
         
-        # Calculate features
+        # Calculate features (means of the per-sample scores)
+        work_w, work_h = work_size or (width, height)
+        edge_pixels = proxy_size[0] * proxy_size[1] if EDGE_PROXY else work_w * work_h
         features = {
-            'edge_density': np.mean(edge_scores) if edge_scores else 0,
-            'motion_score': np.mean(motion_scores) if motion_scores else 0,
-            'brightness': np.mean(brightness_scores) if brightness_scores else 0,
-            'color_variance': np.mean(color_variances) if color_variances else 0,
+            'edge_density': edge_sum / n / edge_pixels if n else 0,
+            'motion_score': motion_sum / (n - 1) / 255.0 if n > 1 else 0,
+            'brightness': brightness_sum / n / 255.0 if n else 0,
+            'color_variance': color_sum / n / 255.0 if n else 0,
             'resolution': width * height,
             'fps': fps,
-            'duration': duration
+            'duration': duration,
+            'sampled_frames': n  # 0: nothing decoded, the features are placeholders
         }
         
-        return features
+        if n:
+            with _FEATURE_CACHE_LOCK:
+                _FEATURE_CACHE[key] = features
+                while len(_FEATURE_CACHE) > FEATURE_CACHE_SIZE:
+                    _FEATURE_CACHE.popitem(last=False)
+        return dict(features)
     
     except Exception as e:
         print(f"Error extracting features: {e}")
@@ -197,19 +741,19 @@ def extract_ml_features(video_path):
             'color_variance': 0.2,
             'resolution': 1920 * 1080,
             'fps': 30,
-            'duration': 30
+            'duration': 30,
+            'sampled_frames': 0
         }
 
-def analyze_video_complexity(video_path):
+def complexity_score(features):
     """
-    Analyze video complexity using OpenCV
-    Returns a complexity score from 0-10 based on edge density and motion
+    Complexity score from 0-10 based on edge density and motion
+    features: output of extract_ml_features (no further frame access)
     """
     try:
-        features = extract_ml_features(video_path)
-        
         # Calculate simple complexity score for display
-        edge_normalized = min(10, (features['edge_density'] / 0.15) * 10)
+        edge_norm = SOBEL_EDGE_NORM if EDGE_PROXY else CANNY_EDGE_NORM
+        edge_normalized = min(10, (features['edge_density'] / edge_norm) * 10)
         motion_normalized = min(10, (features['motion_score'] / 0.10) * 10)
         
         complexity = (edge_normalized * 0.6 + motion_normalized * 0.4)
@@ -248,54 +792,148 @@ def calculate_co2(energy_joules, carbon_intensity=None):
     co2_grams = energy_kwh * carbon_intensity
     return round(co2_grams, 2)
 
-def save_to_excel(data):
+def save_results(data):
     """
-    Save results to Excel file (append if exists, create if not)
+    Append one results row to the CSV log (header written when the file is new)
+    O(1) per upload - the Excel workbook is only built on demand by /export.xlsx
     """
     try:
-        print(f"Attempting to save to Excel: {RESULTS_FILE}")
-        
-        # Check if Excel file exists
-        if os.path.exists(RESULTS_FILE):
-            print("Excel file exists, loading...")
-            wb = load_workbook(RESULTS_FILE)
-            ws = wb.active
-        else:
-            # Create new workbook with headers
-            print("Creating new Excel file...")
-            wb = Workbook()
-            ws = wb.active
-            ws.append([
-                'Timestamp', 'Filename', 'Complexity', 
-                'Normal_Energy_J', 'Rule_Energy_J', 'ML_Energy_J',
-                'Rule_Savings_%', 'ML_Savings_%',
-                'CO2_Normal_g', 'CO2_Rule_g', 'CO2_ML_g'
+        with open(RESULTS_CSV, 'a', newline='') as f:
+            if fcntl:
+                # Several gunicorn workers may append to the same log
+                fcntl.flock(f, fcntl.LOCK_EX)
+            writer = csv.writer(f)
+            # Size under the lock (f.tell() is still the offset from before another
+            # worker's append); a new log starts with the header
+            if os.fstat(f.fileno()).st_size == 0:
+                if os.path.exists(RESULTS_FILE):
+                    # One-time migration: carry rows (header included) over from the old results.xlsx
+                    print(f"Migrating existing Excel results to {RESULTS_CSV}...")
+                    wb = load_workbook(RESULTS_FILE, read_only=True)
+                    writer.writerows(wb.active.iter_rows(values_only=True))
+                    wb.close()
+                else:
+                    writer.writerow(RESULTS_HEADER)
+            writer.writerow([
+                data['timestamp'],
+                data['filename'],
+                data['complexity'],
+                data['normal_energy'],
+                data['rule_energy'],
+                data['ml_energy'],
+                data['rule_savings_percent'],
+                data['ml_savings_percent'],
+                data['co2_normal'],
+                data['co2_rule'],
+                data['co2_ml']
             ])
-        
-        # Append new data
-        ws.append([
-            data['timestamp'],
-            data['filename'],
-            data['complexity'],
-            data['normal_energy'],
-            data['rule_energy'],
-            data['ml_energy'],
-            data['rule_savings_percent'],
-            data['ml_savings_percent'],
-            data['co2_normal'],
-            data['co2_rule'],
-            data['co2_ml']
-        ])
-        
-        # Save workbook
-        wb.save(RESULTS_FILE)
-        print(f"✅ Results saved successfully to {RESULTS_FILE}")
+        print(f"✅ Results saved successfully to {RESULTS_CSV}")
     
     except Exception as e:
-        print(f"❌ Error saving to Excel: {e}")
+        print(f"❌ Error saving results: {e}")
         import traceback
         traceback.print_exc()
 
+# Results rows are written by one daemon thread, so jobs never wait on the file
+# and concurrent jobs can't interleave writes
+RESULTS_Q = queue.Queue()
+
+def results_writer():
+    """Consume RESULTS_Q forever, appending each row with save_results"""
+    while True:
+        save_results(RESULTS_Q.get())
+        RESULTS_Q.task_done()
+
+threading.Thread(target=results_writer, daemon=True).start()
+atexit.register(RESULTS_Q.join)  # don't drop queued rows on shutdown
+
+# Last built export: ((csv mtime_ns, size), xlsx bytes) - rebuilt only after new rows
+_EXPORT_CACHE = {}
+_EXPORT_CACHE_LOCK = threading.Lock()
+
+@app.route('/export.xlsx')
+def export_results():
+    """Serve the CSV log as an Excel workbook (rebuilt only when the CSV has changed)"""
+    try:
+        st = os.stat(RESULTS_CSV)
+    except FileNotFoundError:
+        return jsonify({'error': 'No results yet'}), 404
+    key = (st.st_mtime_ns, st.st_size)
+    
+    with _EXPORT_CACHE_LOCK:
+        if _EXPORT_CACHE.get('key') != key:
+            _EXPORT_CACHE['key'], _EXPORT_CACHE['data'] = key, build_results_workbook()
+        data = _EXPORT_CACHE['data']
+    
+    return send_file(io.BytesIO(data), as_attachment=True, download_name='results.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+def build_results_workbook():
+    """The CSV log as .xlsx bytes (streamed rows, write-only mode)"""
+    def to_cell(value):
+        # CSV stores everything as text; restore numbers so Excel can chart them
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    with open(RESULTS_CSV, newline='') as f:
+        reader = csv.reader(f)
+        ws.append(next(reader, RESULTS_HEADER))
+        for row in reader:
+            ws.append([to_cell(value) for value in row])
+    
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+def parse_gemini_json(response_text):
+    """
+    Parse the JSON object in a Gemini reply, with or without a ```json fence
+    Falls back to the first flat {...} in the text for replies with extra prose
+    Returns: dict, or None if no JSON object was found
+    """
+    text = response_text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            return data
+    except json.JSONDecodeError:
+        pass
+    json_match = re.search(r'\{[^}]+\}', response_text, re.DOTALL)
+    if json_match:
+        try:
+            return json.loads(json_match.group(0))
+        except json.JSONDecodeError:
+            pass
+    return None
+
+def carbon_cache_key(lat, lon):
+    """Round coordinates to the 0.5° grid cell they fall in"""
+    return (round(float(lat) * 2) / 2, round(float(lon) * 2) / 2)
+
+def get_cached_carbon_intensity(key):
+    """Cached lookup result for this cell, or None if missing/expired"""
+    with CARBON_INTENSITY_CACHE_LOCK:
+        entry = CARBON_INTENSITY_CACHE.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del CARBON_INTENSITY_CACHE[key]
+            return None
+        CARBON_INTENSITY_CACHE.move_to_end(key)
+        return entry[0]
+
+def cache_carbon_intensity(key, result):
+    """Remember a successful lookup for CARBON_CACHE_TTL"""
+    with CARBON_INTENSITY_CACHE_LOCK:
+        CARBON_INTENSITY_CACHE[key] = (result, time.time() + CARBON_CACHE_TTL)
+        CARBON_INTENSITY_CACHE.move_to_end(key)
+        while len(CARBON_INTENSITY_CACHE) > CARBON_CACHE_SIZE:
+            CARBON_INTENSITY_CACHE.popitem(last=False)
+
 @app.route('/api/carbon-intensity', methods=['POST'])
 def get_carbon_intensity():
     """
@@ -316,6 +954,13 @@ def get_carbon_intensity():
                 'error': 'Missing coordinates'
             }), 200
         
+        # Same grid cell looked up recently: no geocoding or Gemini call needed
+        cache_key = carbon_cache_key(lat, lon)
+        cached = get_cached_carbon_intensity(cache_key)
+        if cached:
+            print(f"♻️  Carbon intensity cache hit: {cached['region']} = {cached['intensity']} g/kWh")
+            return jsonify(cached), 200
+        
         # Check if Gemini API is configured
         if not GEMINI_API_KEY:
             print("⚠️  Gemini API key not set, using default")
@@ -329,8 +974,7 @@ def get_carbon_intensity():
         # Reverse geocode coordinates to get location name using free API
         try:
             geocode_url = f"https://nominatim.openstreetmap.org/reverse?lat={lat}&lon={lon}&format=json"
-            headers = {'User-Agent': 'GreenAI-VideoTranscoder/1.0'}
-            geo_response = requests.get(geocode_url, headers=headers, timeout=5)
+            geo_response = HTTP.get(geocode_url, timeout=5)
             geo_data = geo_response.json()
             
             # Extract region info
@@ -346,8 +990,6 @@ def get_carbon_intensity():
         
         # Call Gemini API with strict prompt
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash')
-            
             prompt = f"""You are a precise data lookup assistant for electricity grid carbon intensity.
 
 Location: {location_name}
@@ -380,17 +1022,13 @@ Example valid response:
 
 Return ONLY the JSON object:"""
             
-            response = model.generate_content(prompt)
+            response = GEMINI_MODEL.generate_content(prompt)
             response_text = response.text.strip()
             
             print(f"🤖 Gemini raw response: {response_text}")
             
-            # Extract JSON from response (remove markdown code blocks if present)
-            json_match = re.search(r'\{[^}]+\}', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(0)
-                gemini_data = json.loads(json_str)
-                
+            gemini_data = parse_gemini_json(response_text)
+            if gemini_data:
                 region = gemini_data.get('region', location_name)
                 intensity = gemini_data.get('intensity')
                 source = gemini_data.get('source', 'Gemini AI')
@@ -399,13 +1037,15 @@ Return ONLY the JSON object:"""
                 # Validate intensity is reasonable
                 if isinstance(intensity, (int, float)) and 0 <= intensity <= 1500:
                     print(f"✅ Carbon intensity: {region} = {intensity} g/kWh ({year}, {source})")
-                    return jsonify({
+                    result = {
                         'region': region,
                         'intensity': float(intensity),
                         'source': 'gemini',
                         'year': year,
                         'data_source': source
-                    }), 200
+                    }
+                    cache_carbon_intensity(cache_key, result)
+                    return jsonify(result), 200
                 else:
                     print(f"⚠️  Invalid intensity value: {intensity}")
                     raise ValueError("Invalid carbon intensity value")
@@ -431,6 +1071,116 @@ Return ONLY the JSON object:"""
             'error': str(e)
         }), 200
 
+def file_size_mb(path):
+    """File size in MB from a single stat() call, or None if the file doesn't exist"""
+    try:
+        return os.stat(path).st_size / (1024 * 1024)
+    except FileNotFoundError:
+        return None
+
+def hash_file(path):
+    """Streaming BLAKE2b content hash of a file on disk"""
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def stored_upload_name(filename):
+    """
+    Unique on-disk name for an upload: uuid + the original extension
+    (the client's name is only kept for display, so non-ASCII names work and
+    repeated names don't overwrite each other)
+    Returns: e.g. '3f2a...9c.mp4', or None if the name has no usable extension
+    """
+    ext = os.path.splitext(os.path.basename((filename or '').replace('\\', '/')))[1].lower()
+    if len(ext) < 2 or not (ext[1:].isascii() and ext[1:].isalnum()):
+        return None  # FFmpeg picks the output muxer from the extension
+    return uuid.uuid4().hex + ext
+
+def save_upload(file, input_path):
+    """
+    Move a multipart upload into place
+    DiskSpooledRequest already streamed it into UPLOAD_FOLDER, so this is a rename, not a copy
+    Returns: BLAKE2b content hash of the upload
+    """
+    spool_path = getattr(file.stream, 'name', None)
+    if isinstance(spool_path, str) and os.path.dirname(spool_path) == UPLOAD_FOLDER:
+        file.stream.flush()
+        os.replace(spool_path, input_path)
+        return file.stream.hash.hexdigest()
+    
+    file.save(input_path)
+    return hash_file(input_path)
+
+def load_cached_analysis(content_hash):
+    """
+    Look up a previous analysis of the same file content
+    Returns: (complexity, video_info, ml_prediction) or None; ml_prediction is
+    (crf, preset), or None if no ML prediction was stored
+    """
+    try:
+        with closing(sqlite3.connect(ANALYSIS_CACHE_DB)) as db:
+            row = db.execute(
+                'SELECT complexity, width, height, fps, duration, ml_crf, ml_preset FROM analysis '
+                'WHERE hash = ? AND config = ?',  # other settings/models: a miss, re-analysed
+                (content_hash, ANALYSIS_CONFIG)
+            ).fetchone()
+    except sqlite3.Error as e:
+        print(f"⚠️ Analysis cache read failed: {e}")
+        return None
+    if row is None:
+        return None
+    complexity, width, height, fps, duration, ml_crf, ml_preset = row
+    video_info = {'width': width, 'height': height, 'fps': fps, 'duration': duration or 0}
+    ml_prediction = (ml_crf, ml_preset) if ml_crf is not None and ml_preset else None
+    return complexity, video_info, ml_prediction
+
+def store_cached_analysis(content_hash, complexity, video_info, ml_prediction=None):
+    """Remember complexity + metadata (+ the ML (crf, preset) prediction) for this file content"""
+    ml_crf, ml_preset = ml_prediction or (None, None)
+    try:
+        with closing(sqlite3.connect(ANALYSIS_CACHE_DB)) as db, db:
+            db.execute(
+                'INSERT OR REPLACE INTO analysis '
+                '(hash, complexity, width, height, fps, duration, ml_crf, ml_preset, config) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (content_hash, complexity, video_info['width'], video_info['height'], video_info['fps'],
+                 video_info['duration'], ml_crf, ml_preset, ANALYSIS_CONFIG)
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ Analysis cache write failed: {e}")
+
+def parse_carbon_intensity(value):
+    """Carbon intensity sent by the client, or the default if missing/invalid"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return DEFAULT_CARBON_INTENSITY
+
+def start_job(input_path, filename, carbon_intensity, content_hash=None):
+    """Register a job for a saved upload and start processing it in the background"""
+    # Generate unique job ID
+    job_id = str(uuid.uuid4())
+    
+    # Initialize job status
+    jobs[job_id] = {
+        'status': 'processing',
+        'progress': 0,
+        'result': None,
+        'error': None,
+        'filename': filename
+    }
+    
+    # Queue background processing (runs as soon as a job worker is free)
+    JOB_EXECUTOR.submit(process_video_background, job_id, input_path, filename,
+                        carbon_intensity, content_hash)
+    
+    print(f"✅ Job {job_id} started in background")
+    
+    # Return job ID immediately
+    return jsonify({'job_id': job_id}), 202
+
 @app.route('/upload', methods=['POST'])
 def upload_video():
     print("=" * 80)
@@ -443,42 +1193,59 @@ def upload_video():
     file = request.files['video']
     print(f"📹 File received: {file.filename}")
     
-    # Generate unique job ID
-    job_id = str(uuid.uuid4())
+    stored_name = stored_upload_name(file.filename)
+    if not stored_name:
+        # Drop the already spooled body
+        spool_path = getattr(file.stream, 'name', None)
+        file.close()
+        if isinstance(spool_path, str) and os.path.dirname(spool_path) == UPLOAD_FOLDER:
+            os.remove(spool_path)
+        return jsonify({'error': 'Filename needs a video extension, e.g. .mp4'}), 400
     
     # Save file
-    input_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(input_path)
+    input_path = os.path.join(UPLOAD_FOLDER, stored_name)
+    content_hash = save_upload(file, input_path)
     print(f"💾 File saved to: {input_path}")
     
     # Get carbon intensity from request
-    carbon_intensity = request.form.get('carbon_intensity', DEFAULT_CARBON_INTENSITY)
-    try:
-        carbon_intensity = float(carbon_intensity)
-    except:
-        carbon_intensity = DEFAULT_CARBON_INTENSITY
+    carbon_intensity = parse_carbon_intensity(request.form.get('carbon_intensity'))
     
-    # Initialize job status
-    jobs[job_id] = {
-        'status': 'processing',
-        'progress': 0,
-        'result': None,
-        'error': None,
-        'filename': file.filename
-    }
+    return start_job(input_path, file.filename, carbon_intensity, content_hash)
+
+@app.route('/upload_raw', methods=['POST'])
+def upload_video_raw():
+    """
+    Raw-body upload: the client POSTs the video bytes as application/octet-stream
+    Query: ?filename=clip.mp4&carbon_intensity=710
+    The body is streamed to disk in 1 MB chunks - no multipart parsing, no spooling
+    """
+    print("=" * 80)
+    print("🚀 RAW UPLOAD ROUTE CALLED!")
+    print("=" * 80)
     
-    # Start background processing
-    thread = threading.Thread(
-        target=process_video_background,
-        args=(job_id, input_path, file.filename, carbon_intensity)
-    )
-    thread.daemon = True
-    thread.start()
+    filename = request.args.get('filename', '')
+    if not filename:
+        return jsonify({'error': 'No filename'}), 400
+    stored_name = stored_upload_name(filename)
+    if not stored_name:
+        return jsonify({'error': 'Filename needs a video extension, e.g. .mp4'}), 400
+    print(f"📹 File received: {filename}")
     
-    print(f"✅ Job {job_id} started in background")
+    # Stream request body straight to the final path, hashing it on the way
+    input_path = os.path.join(UPLOAD_FOLDER, stored_name)
+    try:
+        with open(input_path, 'wb') as f:
+            writer = HashingWriter(f)
+            shutil.copyfileobj(request.stream, writer, length=1 << 20)
+    except BaseException:
+        # Too large (413), client disconnect, ...: don't leave a partial upload behind
+        os.remove(input_path)
+        raise
+    print(f"💾 File saved to: {input_path}")
     
-    # Return job ID immediately
-    return jsonify({'job_id': job_id}), 202
+    carbon_intensity = parse_carbon_intensity(request.args.get('carbon_intensity'))
+    
+    return start_job(input_path, filename, carbon_intensity, writer.hash.hexdigest())
     
 @app.route('/status/<job_id>', methods=['GET'])
 def get_job_status(job_id):
@@ -494,60 +1261,169 @@ def get_job_status(job_id):
         'error': job['error']
     })
 
-def process_video_background(job_id, input_path, filename, carbon_intensity):
-    """Background processing function"""
+def extract_video_info(input_path, cap=None):
+    """
+    Read width/height/fps/duration from the container plus the file size
+    cap: optional already opened capture to read from (left open for the caller)
+    Returns: video_info dict, or None if the metadata can't be read
+    """
     try:
-        # Extract video metadata
-        jobs[job_id]['progress'] = 5
-        try:
+        own_cap = cap is None
+        if own_cap:
             cap = cv2.VideoCapture(input_path)
-            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = int(cap.get(cv2.CAP_PROP_FPS))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = int(cap.get(cv2.CAP_PROP_FPS))
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        duration = frame_count / cap.get(cv2.CAP_PROP_FPS) if fps > 0 else 0
+        if own_cap:
             cap.release()
-            size_mb = os.path.getsize(input_path) / (1024 * 1024)
-            
-            video_info = {
-                'width': width,
-                'height': height,
-                'fps': fps,
-                'size_mb': size_mb
-            }
-            print(f"📊 Video: {width}x{height} @ {fps}fps, {size_mb:.2f}MB")
-        except Exception as e:
-            print(f"⚠️ Could not extract metadata: {e}")
-            video_info = None
+        size_mb = file_size_mb(input_path)
         
+        video_info = {
+            'width': width,
+            'height': height,
+            'fps': fps,
+            'duration': duration,
+            'size_mb': size_mb
+        }
+        print(f"📊 Video: {width}x{height} @ {fps}fps, {size_mb:.2f}MB")
+        return video_info
+    except Exception as e:
+        print(f"⚠️ Could not extract metadata: {e}")
+        return None
+
+def encode_tracker(job_id, output_count):
+    """
+    Map the FFmpeg progress of a job's transcodes onto its 20-80 progress band
+    output_count: number of outputs the job encodes
+    Returns: tracker(modes) giving the on_progress callback for one FFmpeg run
+    """
+    progress_step = 60 // output_count
+    done = {}
+    
+    def tracker(modes):
+        # FFmpeg progress callback: fraction of the input encoded by this run
+        def on_progress(fraction):
+            for mode in modes:
+                done[mode] = fraction
+            # Never step back: an overlapped baseline may report before the analysis ends
+            jobs[job_id]['progress'] = max(jobs[job_id]['progress'],
+                                           20 + int(progress_step * sum(done.values())))
+        return on_progress
+    return tracker
+
+def run_transcodes(job_id, input_path, outputs, complexity, video_info, ml_prediction=None,
+                   started=None, tracker=None):
+    """
+    Run transcode_video for each (mode, output_path) pair
+    SINGLE_PASS: all outputs come out of one shared FFmpeg run
+    Jobs run side by side when the host has spare cores (TRANSCODE_WORKERS > 1),
+    otherwise one after another
+    Job progress moves from 20 to 80 as FFmpeg reports encoded time
+    ml_prediction: (crf, preset) for the ML output, predicted on demand if None
+    started: {mode: future} for transcodes already running (collected at the end)
+    tracker: encode_tracker the started transcodes report to, created if None
+    Returns: {mode: (energy, duration, settings_dict)}
+    """
+    results = {}
+    tracker = tracker or encode_tracker(job_id, len(outputs))
+    started = started or {}
+    outputs = [(mode, output_path) for mode, output_path in outputs if mode not in started]
+    
+    if SINGLE_PASS:
+        # The ML settings are predicted before transcoding, so every output's
+        # encoder settings are known before the single decode starts
+        results.update(transcode_single_pass(input_path, outputs, complexity, video_info,
+                                             tracker([mode for mode, _ in outputs]), ml_prediction))
+        return results
+    
+    if TRANSCODE_WORKERS > 1:
+        with ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS) as executor:
+            futures = {
+                executor.submit(transcode_video, input_path, output_path, mode,
+                                complexity, video_info, tracker([mode]), ml_prediction): mode
+                for mode, output_path in outputs
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    else:
+        for mode, output_path in outputs:
+            results[mode] = transcode_video(input_path, output_path, mode, complexity, video_info,
+                                            tracker([mode]), ml_prediction)
+    
+    for mode, future in started.items():
+        results[mode] = future.result()
+        tracker([mode])(1.0)
+    
+    return results
+
+def process_video_background(job_id, input_path, filename, carbon_intensity, content_hash=None):
+    """
+    Background processing function
+    content_hash: BLAKE2b of the upload; re-uploads of the same content reuse the cached analysis
+    """
+    try:
         # Step 1: Get input file size
-        input_size_mb = os.path.getsize(input_path) / (1024 * 1024)
+        jobs[job_id]['progress'] = 5
+        input_size_mb = file_size_mb(input_path)
+        
+        # Outputs are named after the stored upload; filename is only for display
+        stored_name = os.path.basename(input_path)
+        normal_output = os.path.join(OUTPUT_FOLDER, 'normal_' + stored_name)
+        rule_output = os.path.join(OUTPUT_FOLDER, 'rule_' + stored_name)
+        outputs = [('normal', normal_output), ('rule', rule_output)]
+        if ML_AVAILABLE:
+            ml_output = os.path.join(OUTPUT_FOLDER, 'ml_' + stored_name)
+            outputs.append(('ml', ml_output))
         
-        # Step 2: Analyze video complexity
-        jobs[job_id]['progress'] = 10
-        print("Analyzing video complexity...")
-        complexity = analyze_video_complexity(input_path)
+        # Step 2: Extract metadata and analyze complexity (skipped for known content)
+        cached = load_cached_analysis(content_hash) if content_hash else None
+        started = {}
+        tracker = encode_tracker(job_id, len(outputs))
+        if cached:
+            complexity, video_info, ml_prediction = cached
+            features = None  # not kept in the cache; re-extracted only if ML settings are missing
+            video_info['size_mb'] = input_size_mb
+            print(f"♻️  Analysis cache hit ({content_hash})")
+        else:
+            # One container open: metadata first, then the analysis samples frames from it
+            print("Analyzing video complexity...")
+            cap = open_video_capture(input_path)
+            video_info = extract_video_info(input_path, cap)
+            if OVERLAP_BASELINE:
+                # The baseline encode doesn't depend on the analysis: run it alongside
+                # (the metadata is already read, so it reports progress as it encodes)
+                baseline = ThreadPoolExecutor(max_workers=1)
+                started['normal'] = baseline.submit(transcode_video, input_path, normal_output, 'normal',
+                                                    None, video_info, tracker(['normal']))
+                baseline.shutdown(wait=False)
+            features = extract_ml_features(input_path, cap)
+            complexity = complexity_score(features)
+            ml_prediction = None
         print(f"Complexity score: {complexity}/10")
         
-        # Step 3: Normal transcoding (standard settings)
-        jobs[job_id]['progress'] = 20
-        normal_output = os.path.join(OUTPUT_FOLDER, 'normal_' + filename)
-        normal_energy, normal_time, normal_settings = transcode_video(
-            input_path, normal_output, 'normal', complexity, video_info
-        )
-        
-        # Step 4: Rule-based Green AI transcoding
-        jobs[job_id]['progress'] = 50
-        rule_output = os.path.join(OUTPUT_FOLDER, 'rule_' + filename)
-        rule_energy, rule_time, rule_settings = transcode_video(
-            input_path, rule_output, 'rule', complexity, video_info
-        )
-        
-        # Step 5: ML-based Green AI transcoding (if available)
-        jobs[job_id]['progress'] = 80
+        # ML settings are predicted once per content (features come from the analysis above)
+        needs_prediction = ML_AVAILABLE and ml_prediction is None
+        if needs_prediction:
+            if features is None:
+                features = extract_ml_features(input_path)
+            ml_prediction = predict_ml_settings(input_path, features)
+        # Only persist a real analysis: the sqlite cache outlives the process, so a
+        # fallback (no frames decoded, unreadable metadata) must not stick to this content
+        analysis_ok = (features is None or features['sampled_frames'] > 0) and bool(
+            video_info and video_info['width'] > 0 and video_info['height'] > 0 and video_info['fps'] > 0)
+        if content_hash and analysis_ok and (not cached or needs_prediction):
+            store_cached_analysis(content_hash, complexity, video_info, ml_prediction)
+        
+        # Steps 3-5: Normal, rule-based and ML-based (if available) transcoding
+        jobs[job_id]['progress'] = max(jobs[job_id]['progress'], 20)
+        results = run_transcodes(job_id, input_path, outputs, complexity, video_info, ml_prediction,
+                                 started, tracker)
+        normal_energy, normal_time, normal_settings = results['normal']
+        rule_energy, rule_time, rule_settings = results['rule']
         if ML_AVAILABLE:
-            ml_output = os.path.join(OUTPUT_FOLDER, 'ml_' + filename)
-            ml_energy, ml_time, ml_settings = transcode_video(
-                input_path, ml_output, 'ml', complexity, video_info
-            )
+            ml_energy, ml_time, ml_settings = results['ml']
         else:
             # Fallback to rule-based if ML not available
             ml_output = rule_output
@@ -555,9 +1431,9 @@ def process_video_background(job_id, input_path, filename, carbon_intensity):
             ml_settings['mode'] = 'ML (Unavailable - Using Rules)'
         
         # Step 6: Get output file sizes and calculate storage savings
-        normal_size_mb = os.path.getsize(normal_output) / (1024 * 1024) if os.path.exists(normal_output) else 0
-        rule_size_mb = os.path.getsize(rule_output) / (1024 * 1024) if os.path.exists(rule_output) else 0
-        ml_size_mb = os.path.getsize(ml_output) / (1024 * 1024) if os.path.exists(ml_output) else 0
+        normal_size_mb = file_size_mb(normal_output) or 0
+        rule_size_mb = file_size_mb(rule_output) or 0
+        ml_size_mb = file_size_mb(ml_output) or 0
         
         rule_storage_saved_mb = normal_size_mb - rule_size_mb
         rule_storage_saved_percent = (rule_storage_saved_mb / normal_size_mb) * 100 if normal_size_mb > 0 else 0
@@ -579,7 +1455,7 @@ def process_video_background(job_id, input_path, filename, carbon_intensity):
         co2_rule_saved = co2_normal - co2_rule
         co2_ml_saved = co2_normal - co2_ml
         
-        # Step 8: Save to Excel
+        # Step 8: Save results
         jobs[job_id]['progress'] = 95
         excel_data = {
             'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
@@ -602,7 +1478,7 @@ def process_video_background(job_id, input_path, filename, carbon_intensity):
             'co2_rule_saved': round(co2_rule_saved, 4),
             'co2_ml_saved': round(co2_ml_saved, 4)
         }
-        save_to_excel(excel_data)
+        RESULTS_Q.put(excel_data)
         
         # Step 9: Store results
         jobs[job_id]['status'] = 'completed'
@@ -636,9 +1512,9 @@ def process_video_background(job_id, input_path, filename, carbon_intensity):
             'co2_rule_saved': round(co2_rule_saved, 4),
             'co2_ml_saved': round(co2_ml_saved, 4),
             'ml_available': ML_AVAILABLE,
-            'normal_video_url': f'/outputs/normal_{filename}',
-            'rule_video_url': f'/outputs/rule_{filename}',
-            'ml_video_url': f'/outputs/ml_{filename}'
+            'normal_video_url': f'/outputs/normal_{stored_name}',
+            'rule_video_url': f'/outputs/rule_{stored_name}',
+            'ml_video_url': f'/outputs/ml_{stored_name}'
         }
         
         print(f"✅ Job {job_id} completed successfully")
@@ -648,57 +1524,125 @@ def process_video_background(job_id, input_path, filename, carbon_intensity):
         jobs[job_id]['status'] = 'failed'
         jobs[job_id]['error'] = str(e)
 
-def transcode_video(input_path, output_path, mode, complexity, video_info=None):
+# Fixed argv pieces, built once at import (stderr only carries errors, kept for reporting)
+FFMPEG_PROGRESS_ARGS = ['-hide_banner', '-loglevel', 'error', '-progress', 'pipe:1', '-nostats']
+X264_OUTPUT_ARGS = ['-threads', str(X264_THREADS), '-pix_fmt', 'yuv420p']
+NORMAL_CODEC_ARGS = ['-c:v', 'libx264', '-crf', '23'] + X264_OUTPUT_ARGS  # baseline, never changes
+
+def run_ffmpeg_measured(cmd, duration=0, on_progress=None):
+    """
+    Run an FFmpeg command and measure that process only
+    FFmpeg writes key=value progress lines to stdout (-progress pipe:1); with the
+    input duration known, on_progress gets the encoded fraction (0-1) as it goes
+    Returns: (wall_seconds, cpu_seconds) where cpu_seconds is FFmpeg's own user+system
+    time, as accounted by the kernel over the whole process lifetime (all threads)
+    Raises RuntimeError with the end of FFmpeg's error output if it exits non-zero
+    """
+    cmd = cmd[:1] + FFMPEG_PROGRESS_ARGS + cmd[1:]
+    # stderr goes to a file, not a pipe: nothing drains it while progress is read
+    with tempfile.TemporaryFile() as stderr:
+        start_time = time.perf_counter()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        
+        # Drain progress until FFmpeg closes stdout (out_time_us is in microseconds)
+        for line in proc.stdout:
+            if on_progress and duration > 0 and line.startswith(b'out_time_us='):
+                try:
+                    on_progress(min(1.0, int(line[12:]) / (duration * 1e6)))
+                except ValueError:
+                    pass  # 'N/A' before the first frame is written
+        proc.stdout.close()
+        
+        # Reap FFmpeg ourselves: wait4 hands back its resource usage with the exit status
+        _, status, rusage = os.wait4(proc.pid, 0)
+        end_time = time.perf_counter()
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        
+        if proc.returncode != 0:
+            stderr.seek(max(0, stderr.seek(0, os.SEEK_END) - 1000))
+            tail = stderr.read().decode(errors='replace').strip()
+            raise RuntimeError(f"FFmpeg exited with code {proc.returncode}: {tail or 'no error output'}")
+    if on_progress:
+        on_progress(1.0)
+    
+    cpu_seconds = rusage.ru_utime + rusage.ru_stime
+    return end_time - start_time, cpu_seconds
+
+def disable_hw_encoder(error):
+    """Fall back to libx264 for the rest of the process after a hardware encode failed"""
+    global HW_ENCODER
+    if HW_ENCODER:
+        print(f"⚠️  {HW_ENCODER} encode failed, using libx264 from now on: {error}")
+        HW_ENCODER = None
+
+def adaptive_codec_name():
+    """Codec label shown for the rule/ML outputs"""
+    for encoder, _, label in HW_ENCODERS:
+        if encoder == HW_ENCODER:
+            return f'H.264 ({label})'
+    return 'H.264 (libx264)'
+
+def adaptive_codec_args(preset, crf):
+    """
+    Encoder args for the rule/ML outputs
+    Hardware encoders get their quality level from the CRF table (NVENC -cq, VA-API
+    constant QP, QSV -global_quality); the x264 preset only applies to libx264
+    With VA-API the frames are uploaded to the GPU first
+    """
+    if HW_ENCODER == 'h264_nvenc':
+        return ['-c:v', 'h264_nvenc', '-preset', 'p4', '-cq', crf]
+    if HW_ENCODER == 'h264_qsv':
+        return ['-c:v', 'h264_qsv', '-global_quality', crf]
+    if HW_ENCODER == 'h264_vaapi':
+        return [
+            '-vf', 'format=nv12,hwupload',
+            '-c:v', 'h264_vaapi',
+            '-qp', crf
+        ]
+    return ['-c:v', 'libx264', '-preset', preset, '-crf', crf] + X264_OUTPUT_ARGS
+
+def adaptive_encoder_fields(preset, crf):
+    """
+    Settings fields that depend on the rule/ML encoder, plus the text describing its tuning
+    Hardware encoders ignore the x264 preset and thread count, and their power draw
+    isn't in the CPU-time energy model, so they're labelled as such
+    Returns: (fields_dict, tuning_text)
+    """
+    if not HW_ENCODER:
+        return {'preset': preset, 'threads': X264_THREADS}, f'{preset} preset + CRF {crf}'
+    fields = {
+        'preset': 'n/a (hardware encoder)',
+        'threads': 'n/a (hardware encoder)',
+        'energy_note': 'Hardware encode: energy counts CPU time only (GPU/ASIC power not measured), not comparable with the libx264 baseline'
+    }
+    return fields, f'quality level {crf} on {adaptive_codec_name()}'
+
+def ffmpeg_input_args(input_path, modes):
+    """FFmpeg args up to and including the input; opens the VA-API device when a mode needs it"""
+    cmd = ['ffmpeg']
+    if HW_ENCODER == 'h264_vaapi' and any(mode != 'normal' for mode in modes):
+        cmd += ['-vaapi_device', VAAPI_DEVICE]
+    return cmd + ['-i', input_path]
+
+def encode_settings(input_path, mode, complexity, video_info=None, ml_prediction=None):
     """
-    Transcode video with mode-specific settings
+    Pick the encoding settings for a mode
     Mode 'normal': Uses standard quality settings (baseline)
     Mode 'rule': Uses rule-based adaptive settings
     Mode 'ml': Uses ML-predicted settings
-    Returns: (energy, duration, settings_dict)
+    Returns: (settings_dict, ffmpeg_codec_args)
     """
-    cpu_percentages = []
-    monitoring = {'active': True}  # Use dict for thread-safe flag
-    
     # Get video metadata if provided
     width = video_info.get('width', 1920) if video_info else 1920
     height = video_info.get('height', 1080) if video_info else 1080
     fps = video_info.get('fps', 30) if video_info else 30
     size_mb = video_info.get('size_mb', 50) if video_info else 50
     
-    # Measure baseline CPU before starting
-    baseline_cpu = psutil.cpu_percent(interval=1.0)
-
-    # Optional FFmpeg warm-up: run a very short FFmpeg invocation to initialize codecs
-    # This helps exclude FFmpeg startup/initialization time from the measured duration.
-    try:
-        warmup_cmd = [
-            'ffmpeg', '-hide_banner', '-loglevel', 'error',
-            '-ss', '0', '-t', '0.1', '-i', input_path,
-            '-f', 'null', '-'  # discard output
-        ]
-        # Run warm-up (do not fail the whole transcoding if warmup errors)
-        subprocess.run(warmup_cmd, capture_output=True, text=True, timeout=10)
-        print("FFmpeg warm-up completed")
-    except Exception as e:
-        print(f"FFmpeg warm-up failed (ignored): {e}")
-
-    # Start CPU monitoring in background thread
-    def monitor_cpu():
-        while monitoring['active']:
-            cpu_percentages.append(psutil.cpu_percent(interval=0.2))
-
-    import threading
-    monitor_thread = threading.Thread(target=monitor_cpu, daemon=True)
-
-    # Use a high-resolution timer and start it immediately before the actual transcode
-    start_time = time.perf_counter()
-    monitor_thread.start()
-    
-    settings = {}  # Track all encoding settings
-    
     if mode == 'ml':
         # ML-based: Use trained Random Forest models to predict optimal settings
-        ml_prediction = predict_ml_settings(input_path)
+        # (reuses the prediction made for this upload when one is passed in)
+        if ml_prediction is None:
+            ml_prediction = predict_ml_settings(input_path)
         
         if ml_prediction:
             crf, preset = ml_prediction
@@ -706,70 +1650,47 @@ def transcode_video(input_path, output_path, mode, complexity, video_info=None):
         else:
             # Fallback to rule-based if ML fails
             preset = predict_optimal_preset(complexity, width, height, fps, size_mb)
-            if complexity < 3.5:
-                crf = '28'
-            elif complexity < 7.0:
-                crf = '26'
-            else:
-                crf = '24'
+            crf = rule_crf(complexity)
         
+        fields, tuning = adaptive_encoder_fields(preset, crf)
         settings = {
             'mode': 'ML-Optimized (Random Forest)',
-            'preset': preset,
+            'preset': fields.pop('preset'),
             'crf': crf,
-            'codec': 'H.264 (libx264)',
-            'threads': 4,
-            'optimization': f'ML-predicted: {preset} preset + CRF {crf} based on 7 features from 192 training videos',
-            'strategy': 'Machine Learning model trained on optimal encoding settings for quality-size tradeoff'
+            'codec': adaptive_codec_name(),
+            'threads': fields.pop('threads'),
+            'optimization': f'ML-predicted: {tuning} based on 7 features from 192 training videos',
+            'strategy': 'Machine Learning model trained on optimal encoding settings for quality-size tradeoff',
+            **fields
         }
         
         print(f"🤖 ML Mode: preset={preset}, CRF={crf}")
         
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264',
-            '-preset', preset,
-            '-crf', crf,
-            '-threads', '4',
-            '-y', output_path
-        ]
+        codec_args = adaptive_codec_args(preset, crf)
     
     elif mode == 'rule':
         # Rule-based: Adaptive preset AND CRF selection based on complexity
         preset = predict_optimal_preset(complexity, width, height, fps, size_mb)
+        crf = rule_crf(complexity)
         
-        # Adaptive CRF: simpler videos can use higher CRF (more compression, smaller file)
-        if complexity < 3.5:
-            crf = '28'  # Low complexity: aggressive compression
-        elif complexity < 7.0:
-            crf = '26'  # Medium complexity: moderate compression
-        else:
-            crf = '24'  # High complexity: preserve quality
-        
+        fields, tuning = adaptive_encoder_fields(preset, crf)
         settings = {
             'mode': 'Rule-Based Adaptive',
-            'preset': preset,
+            'preset': fields.pop('preset'),
             'crf': crf,
-            'codec': 'H.264 (libx264)',
-            'threads': 4,
-            'optimization': f'Rule-based: {preset} preset + CRF {crf} for complexity {complexity:.1f}/10',
-            'strategy': 'Adaptive encoding based on edge detection + motion analysis'
+            'codec': adaptive_codec_name(),
+            'threads': fields.pop('threads'),
+            'optimization': f'Rule-based: {tuning} for complexity {complexity:.1f}/10',
+            'strategy': 'Adaptive encoding based on edge detection + motion analysis',
+            **fields
         }
         
         print(f"📏 Rule-based: complexity={complexity:.1f} → preset={preset}, CRF={crf}")
         
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264',
-            '-preset', preset,
-            '-crf', crf,
-            '-threads', '4',
-            '-y', output_path
-        ]
+        codec_args = adaptive_codec_args(preset, crf)
     
     else:
         # Normal: FFmpeg defaults (industry standard baseline)
-        preset = 'default'  # FFmpeg chooses medium automatically
         crf = '23'
         
         settings = {
@@ -777,51 +1698,138 @@ def transcode_video(input_path, output_path, mode, complexity, video_info=None):
             'preset': 'default (medium)',
             'crf': crf,
             'codec': 'H.264 (libx264)',
-            'threads': 4,
+            'threads': X264_THREADS,
             'optimization': 'None (baseline)',
             'strategy': 'FFmpeg default settings - industry standard'
         }
         
-        cmd = [
-            'ffmpeg', '-i', input_path,
-            '-c:v', 'libx264',
-            '-crf', '23',
-            '-threads', '4',
-            '-y', output_path
-        ]
-    
-    # Run FFmpeg transcoding
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    
-    end_time = time.perf_counter()
-    
-    # Stop monitoring and wait for thread
-    monitoring['active'] = False
-    time.sleep(0.3)  # Give thread time to finish
-    
-    # Calculate metrics
-    duration = end_time - start_time
+        codec_args = NORMAL_CODEC_ARGS
     
-    # Subtract baseline CPU to get only transcoding CPU usage
-    transcoding_cpu_samples = [max(0, cpu - baseline_cpu) for cpu in cpu_percentages]
-    avg_cpu = sum(transcoding_cpu_samples) / len(transcoding_cpu_samples) if transcoding_cpu_samples else 50
-    
-    energy = calculate_energy(duration, avg_cpu)
-    
-    # Add runtime metrics to settings
+    return settings, codec_args
+
+def add_run_metrics(settings, output_path, duration, avg_cpu, energy):
+    """Add runtime metrics and output file size to settings"""
     settings['duration'] = f"{duration:.2f}s"
     settings['avg_cpu'] = f"{avg_cpu:.1f}%"
     settings['energy'] = f"{energy}J"
     
     # Get output file size
-    if os.path.exists(output_path):
-        output_size_mb = os.path.getsize(output_path) / (1024 * 1024)
+    output_size_mb = file_size_mb(output_path)
+    if output_size_mb is not None:
         settings['output_size'] = f"{output_size_mb:.2f} MB"
+
+def transcode_video(input_path, output_path, mode, complexity, video_info=None, on_progress=None,
+                    ml_prediction=None):
+    """
+    Transcode video with mode-specific settings (see encode_settings)
+    CPU usage is FFmpeg's own user+system time over the wall-clock duration,
+    so concurrent transcodes don't skew each other
+    Returns: (energy, duration, settings_dict)
+    """
+    used_hw = HW_ENCODER if mode != 'normal' else None
+    settings, codec_args = encode_settings(input_path, mode, complexity, video_info, ml_prediction)
+    cmd = ffmpeg_input_args(input_path, [mode]) + codec_args + ['-y', output_path]
+    
+    # Run FFmpeg transcoding, measuring only the FFmpeg process
+    try:
+        duration, cpu_seconds = run_ffmpeg_measured(
+            cmd, video_info.get('duration', 0) if video_info else 0, on_progress)
+    except RuntimeError as e:
+        if not used_hw:
+            raise
+        # e.g. device node present but not usable in this container: redo on libx264
+        disable_hw_encoder(e)
+        return transcode_video(input_path, output_path, mode, complexity, video_info, on_progress,
+                               ml_prediction)
     
-    print(f"{mode} mode: duration={duration:.2f}s, baseline_cpu={baseline_cpu:.1f}%, avg_cpu={avg_cpu:.1f}%, energy={energy}J, preset={preset}")
+    # Average CPU as a share of the whole machine (same scale as psutil.cpu_percent)
+    avg_cpu = 100 * cpu_seconds / (duration * CPU_COUNT) if duration > 0 else 50
+    
+    energy = calculate_energy(duration, avg_cpu)
+    add_run_metrics(settings, output_path, duration, avg_cpu, energy)
+    
+    print(f"{mode} mode: duration={duration:.2f}s, cpu_time={cpu_seconds:.2f}s, avg_cpu={avg_cpu:.1f}%, energy={energy}J, preset={settings['preset']}")
     
     return energy, round(duration, 2), settings
 
+def transcode_single_pass(input_path, outputs, complexity, video_info=None, on_progress=None,
+                          ml_prediction=None):
+    """
+    Encode several modes from ONE FFmpeg run: the input is demuxed and decoded once
+    and fed to one encoder per (mode, output_path)
+    A single process can't attribute CPU to individual encoders, so the run's
+    energy and duration are shared equally between the outputs
+    Returns: {mode: (energy, duration, settings_dict)}
+    """
+    used_hw = HW_ENCODER if any(mode != 'normal' for mode, _ in outputs) else None
+    cmd = ffmpeg_input_args(input_path, [mode for mode, _ in outputs])
+    mode_settings = {}
+    for mode, output_path in outputs:
+        settings, codec_args = encode_settings(input_path, mode, complexity, video_info, ml_prediction)
+        settings['measurement'] = f'Single-pass run shared by {len(outputs)} outputs (energy split equally)'
+        mode_settings[mode] = settings
+        cmd += codec_args + ['-y', output_path]
+    
+    try:
+        duration, cpu_seconds = run_ffmpeg_measured(
+            cmd, video_info.get('duration', 0) if video_info else 0, on_progress)
+    except RuntimeError as e:
+        if not used_hw:
+            raise
+        disable_hw_encoder(e)
+        return transcode_single_pass(input_path, outputs, complexity, video_info, on_progress,
+                                     ml_prediction)
+    avg_cpu = 100 * cpu_seconds / (duration * CPU_COUNT) if duration > 0 else 50
+    energy = round(calculate_energy(duration, avg_cpu) / len(outputs), 2)
+    
+    results = {}
+    for mode, output_path in outputs:
+        settings = mode_settings[mode]
+        add_run_metrics(settings, output_path, duration, avg_cpu, energy)
+        results[mode] = (energy, round(duration, 2), settings)
+    
+    print(f"single-pass ({', '.join(mode_settings)}): duration={duration:.2f}s, cpu_time={cpu_seconds:.2f}s, avg_cpu={avg_cpu:.1f}%, energy={energy}J per output")
+    
+    return results
+
+def warm_up():
+    """
+    Run every hot-path component once so the first upload doesn't pay for first-call
+    costs (sklearn predict setup, OpenCV kernel dispatch, Numba compile, FFmpeg binary
+    page-in). Failures are ignored - this is only an optimization
+    Returns: {component: milliseconds}
+    """
+    timings = {}
+    
+    def timed(name, fn):
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"Warm-up of {name} failed (ignored): {e}")
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    
+    gray = np.zeros((16, 16), np.uint8)
+    frame = np.zeros((16, 16, 3), np.uint8)
+    if ML_AVAILABLE:
+        timed('models', lambda: predict_models(np.zeros((1, len(ML_FEATURES)), np.float32)))
+    timed('opencv', lambda: (cv2.Canny(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), 100, 200),
+                             sobel_edge_count(gray, (4, 4)), cv2.absdiff(gray, gray), pooled_std(frame)))
+    if USE_NUMBA:
+        timed('numba', lambda: frame_stats_kernel(gray[:4, :4], gray, gray))
+    timed('ffmpeg', lambda: subprocess.run(['ffmpeg', '-version'], stdout=subprocess.DEVNULL,
+                                           stderr=subprocess.DEVNULL, timeout=10))
+    print(f"🔥 Warm-up done: {timings}")
+    return timings
+
+@app.route('/api/warmup', methods=['POST'])
+def warmup():
+    """Run the warm-up on demand (e.g. from a readiness probe); returns per-component ms"""
+    return jsonify(warm_up()), 200
+
+# Warm up in the background at startup, without delaying the first request
+threading.Thread(target=warm_up, daemon=True).start()
+
 @app.route('/')
 def index():
     return send_from_directory(app.static_folder, 'index.html')
@@ -829,7 +1837,18 @@ def index():
 @app.route('/outputs/<filename>')
 def serve_output(filename):
     """Serve transcoded video files"""
+    if X_ACCEL_OUTPUTS:
+        # Same path checks as send_from_directory; nginx streams the file itself
+        path = safe_join(OUTPUT_FOLDER, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        resp = make_response('')
+        # Percent-encoded: headers are latin-1 only, and nginx decodes the URI itself
+        resp.headers['X-Accel-Redirect'] = X_ACCEL_PREFIX + quote(filename)
+        del resp.headers['Content-Type']  # let nginx set it from the file
+        return resp
     return send_from_directory(OUTPUT_FOLDER, filename)
 
 if __name__ == '__main__':
+    # Local development server; production runs under gunicorn (gunicorn_conf.py)
     app.run(host='0.0.0.0', debug=False, port=5000)
@@ -0,0 +1,21 @@
+"""
+Gunicorn settings for production
+Run from the project root: gunicorn -c backend/gunicorn_conf.py --chdir backend app:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Job state (the jobs dict polled by /status) lives in process memory, so every
+# request for a job must reach the worker that started it: one worker by default.
+# Only raise GUNICORN_WORKERS behind sticky sessions
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+
+# Requests are served by threads: uploads stream in concurrently while the
+# transcodes themselves run in background threads
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# Large uploads over slow links can take a long time to arrive
+timeout = 3600
+graceful_timeout = 30
@@ -83,9 +83,11 @@ async function uploadVideo() {
     isUploading = true;
     console.log(`📤 Starting upload: ${file.name}`);
     
-    const formData = new FormData();
-    formData.append('video', file);
-    formData.append('carbon_intensity', carbonIntensity); // Include carbon intensity
+    // Send the file as the raw request body - the server streams it straight to disk
+    const params = new URLSearchParams({
+        filename: file.name,
+        carbon_intensity: carbonIntensity // Include carbon intensity
+    });
     
     // Show loading
     document.getElementById('loading').style.display = 'block';
@@ -94,9 +96,10 @@ async function uploadVideo() {
     
     try {
         // Submit video - server returns immediately with job ID
-        const response = await fetch(`${API_URL}/upload`, {
+        const response = await fetch(`${API_URL}/upload_raw?${params}`, {
             method: 'POST',
-            body: formData
+            headers: { 'Content-Type': 'application/octet-stream' },
+            body: file
         });
         
         if (!response.ok) {
@@ -282,7 +285,8 @@ function displaySettings(elementId, settings) {
         { key: 'avg_cpu', label: 'Avg CPU', icon: '💻' },
         { key: 'energy', label: 'Energy Used', icon: '⚡' },
         { key: 'output_size', label: 'File Size', icon: '📦' },
-        { key: 'optimization', label: 'Optimization', icon: '🤖' }
+        { key: 'optimization', label: 'Optimization', icon: '🤖' },
+        { key: 'energy_note', label: 'Energy Note', icon: '⚠️' }
     ];
     
     settingsOrder.forEach(({ key, label, icon }) => {